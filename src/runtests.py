@@ -20,7 +20,7 @@ def _run():
                 'NAME': 'test-only',
             }
         },
-        INSTALLED_APPS=['yamldoc'],
+        INSTALLED_APPS=['django.contrib.contenttypes', 'yamldoc'],
     )
 
     django.setup()
@@ -22,22 +22,72 @@ this program. If not, see <https://www.gnu.org/licenses/>.
 
 """
 
+import glob
 import logging
+import multiprocessing
 import os
 import string
 import subprocess
-from argparse import ArgumentParser
+import sys
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import cached_property
 from pathlib import Path
-from typing import Any, Dict, Generator, Optional
+from typing import (Any, BinaryIO, Callable, Dict, Generator, Iterable,
+                    Optional, Sequence, Union)
 
+import django
 import django.core.management.base
-from yamlwrap import dump, load, transform
+from django.core.management.base import CommandError
+from django.db import connections
+from yamlwrap import dump, transform
 
 from yamldoc.util.file import (count_lines, date_of_last_edit, existing_dir,
-                               existing_file, find_assets)
+                               existing_file, find_assets,
+                               find_assets_parallel, forget_git_timestamps,
+                               load, prime_git_timestamps)
 from yamldoc.util.misc import Raw
 
 
+def _name_checker(prefix: Optional[str],
+                  ending: Optional[str]) -> Callable[[str], bool]:
+    """Close over the simplest test of a file name that will do."""
+    if prefix and ending:
+        minimum = len(prefix) + len(ending)
+        return lambda name: (len(name) >= minimum and name.startswith(prefix)
+                             and name.endswith(ending))
+    if prefix:
+        return lambda name: name.startswith(prefix)
+    if ending:
+        return lambda name: name.endswith(ending)
+    return lambda name: True
+
+
+def _job_count(candidate: str) -> int:
+    """Convert a CLI argument to a number of parallel jobs, 0 for automatic."""
+    jobs = int(candidate)
+    if jobs < 0:
+        raise ArgumentTypeError(f"Not a number of jobs: {candidate}")
+    return jobs
+
+
+def _process_pool(workers: int) -> ProcessPoolExecutor:
+    """Prepare worker processes with a working Django site.
+
+    On Linux, workers are forked and inherit the site as configured. Database
+    connections are closed first, so that no worker shares a socket with the
+    parent. Elsewhere, forking may be unsafe, so the platform's default start
+    method is used and each worker sets up Django afresh. That requires
+    settings to be found as for manage.py, through DJANGO_SETTINGS_MODULE.
+
+    """
+    if sys.platform.startswith('linux'):
+        connections.close_all()
+        fork = multiprocessing.get_context('fork')
+        return ProcessPoolExecutor(max_workers=workers, mp_context=fork)
+    return ProcessPoolExecutor(max_workers=workers, initializer=django.setup)
+
+
 class LoggingLevelCommand(django.core.management.base.BaseCommand):
     """A command that uses Django's verbosity for general logging."""
 
@@ -90,13 +140,27 @@ class _RawTextCommand(LoggingLevelCommand):
     def _handle(self, **kwargs):
         raise NotImplementedError()
 
-    def _deserialize_text(self, text: str, **kwargs) -> Raw:
+    def __getstate__(self):
+        """Omit console I/O when pickling, as for a worker process."""
+        state = self.__dict__.copy()
+        for key in ('stdout', 'stderr', 'style', '_name_is_relevant'):
+            state.pop(key, None)
+        if '_args' in state:
+            state['_args'] = {
+                k: v
+                for k, v in state['_args'].items()
+                if k not in ('stdout', 'stderr')
+            }
+        return state
+
+    def _deserialize_text(self, text: Union[str, BinaryIO], **kwargs) -> Raw:
         return load(text, **kwargs)
 
     def _parse_file(self, filepath: Path) -> Raw:
-        logging.debug(f'Parsing {filepath}.')
+        logging.debug('Parsing %s.', filepath)
         assert isinstance(filepath, Path)
-        return self._deserialize_text(filepath.read_text())
+        with filepath.open(mode='rb') as f:
+            return self._deserialize_text(f)
 
     def _serialize_to_text(self, data: Raw, **kwargs) -> str:
         return dump(data, **kwargs)
@@ -104,29 +168,48 @@ class _RawTextCommand(LoggingLevelCommand):
     def _get_assets(self,
                     select_folder=None,
                     select_file=None,
+                    workers=None,
                     **_) -> Generator[Path, None, None]:
-        """Find YAML documents to work on."""
+        """Find YAML documents to work on.
+
+        With a number of workers, folders are read in that many threads and
+        the order of the documents found is not fixed.
+
+        """
         assert select_folder or select_file
-        return find_assets(select_folder,
-                           selection=select_file,
-                           pred=self._filepath_is_relevant)
+        kwargs = dict(pattern=self._glob_pattern(),
+                      selection=select_file,
+                      pred=self._filepath_is_relevant)
+        if workers:
+            return find_assets_parallel(select_folder,
+                                        workers=workers,
+                                        **kwargs)
+        return find_assets(select_folder, **kwargs)
+
+    def _glob_pattern(self) -> str:
+        """Narrow the search by file name, sparing the predicate."""
+        prefix = glob.escape(self._file_prefix or '')
+        ending = glob.escape(self._file_ending or '.yaml')
+        return f'**/{prefix}*{ending}'
+
+    @cached_property
+    def _name_is_relevant(self) -> Callable[[str], bool]:
+        return _name_checker(self._file_prefix, self._file_ending)
 
     def _filepath_is_relevant(self, path: Path) -> bool:
         """Return a Boolean for whether or not a found file is relevant.
 
-        This is a predicate function for find_assets().
+        This is a predicate function for find_assets(). Names are checked
+        before the file system is queried, to spare irrelevant paths a stat.
 
         """
+        if not self._name_is_relevant(path.name):
+            logging.debug("Wrong prefix or suffix in file name: %s.", path)
+            return False
         if not path.is_file():
             # This is expected only if the user indicates a specific file on an
             # invalid path. Globbing is not expected to return non-files.
-            logging.warning(f"Not a file: {path}.")
-            return False
-        if self._file_prefix and not path.name.startswith(self._file_prefix):
-            logging.debug(f"Wrong prefix in file name: {path}.")
-            return False
-        if self._file_ending and not path.suffix == self._file_ending:
-            logging.debug(f"Wrong suffix in file name: {path}.")
+            logging.warning("Not a file: %s.", path)
             return False
         return True
 
@@ -140,6 +223,7 @@ class RawTextEditingCommand(_RawTextCommand):
     _can_describe = False
     _can_update = False
     _takes_subject = True
+    _exec_editor = False
 
     _filename_character_whitelist = string.ascii_letters + string.digits
 
@@ -236,12 +320,28 @@ class RawTextEditingCommand(_RawTextCommand):
                 # Prepare to open the file at the very end.
                 line = count_lines(select_file)
 
-            subprocess.call(['editor', str(select_file), f'+{line}'])
+            self._open_editor(select_file, line)
         else:
             for path in self._get_assets(select_folder=select_folder,
                                          select_file=select_file):
                 self._transform(unwrap, wrap, path)
 
+    def _open_editor(self, path: Path, line: int):
+        """Open a text editor on passed file, at passed line.
+
+        With _exec_editor set, replace the current process with the editor
+        instead of waiting on it. This is only suitable when the command
+        has nothing left to do after editing.
+
+        """
+        args = ['editor', str(path), f'+{line}']
+        if self._exec_editor:
+            logging.shutdown()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.execvp(args[0], args)
+        subprocess.call(args)
+
     def _should_open_editor(self):
         """Determine whether to open a text editor. A stub."""
         return True
@@ -263,11 +363,11 @@ class RawTextEditingCommand(_RawTextCommand):
         """Compose a document on a subject."""
         old_yaml = None
         if is_update:
-            if not filepath.is_file():
+            try:
+                old_yaml = filepath.read_text(encoding='utf-8')
+            except FileNotFoundError:
                 logging.error('File for prior description does not exist.')
                 return
-
-            old_yaml = filepath.read_text()
         else:
             if not filepath.is_file():
                 logging.error('File for new description already exists.')
@@ -289,9 +389,9 @@ class RawTextEditingCommand(_RawTextCommand):
 
     def _write_spec(self, path: Path, new_yaml: Optional[str], mode='w'):
         if not new_yaml:
-            logging.info(f'Not writing to {path}: No new YAML.')
+            logging.info('Not writing to %s: No new YAML.', path)
             return
-        with path.open(mode=mode) as f:
+        with path.open(mode=mode, encoding='utf-8') as f:
             f.write(new_yaml)
 
     def _transform(self, unwrap: bool, wrap: bool, path: Path, **kwargs):
@@ -300,9 +400,8 @@ class RawTextEditingCommand(_RawTextCommand):
         If contents are changed, rewrite the file in place.
 
         """
-        logging.debug(f'Transforming {path}.')
-        assert path.is_file()
-        new = transform(path.read_text(),
+        logging.debug('Transforming %s.', path)
+        new = transform(path.read_text(encoding='utf-8'),
                         unwrap=unwrap,
                         wrap=wrap,
                         loader=self._deserialize_text,
@@ -318,15 +417,30 @@ class RawTextRefinementCommand(_RawTextCommand):
 
     _key_mtime_date = 'date_updated'
 
+    # A folder whose Git history is to be read on the first date lookup.
+    _git_folder: Optional[Path] = None
+
     def add_arguments(self, parser: ArgumentParser):
         """Add additional CLI arguments for refinement."""
         parser = super().add_arguments(parser)
         parser.add_argument('--additive',
                             action='store_true',
                             help='Do not clear relevant table(s) first')
+        parser.add_argument('-j',
+                            '--jobs',
+                            metavar='N',
+                            type=_job_count,
+                            default=1,
+                            help='Parse in N processes (0: one per CPU)')
+        parser.add_argument('--threads',
+                            action='store_true',
+                            help='Use threads instead of processes for jobs')
         return parser
 
     def _handle(self, *args, additive=None, **kwargs):
+        if kwargs.get('threads') and kwargs.get('jobs', 1) == 1:
+            raise CommandError('--threads requires --jobs other than 1.')
+
         if not additive:
             self._clear_database()
 
@@ -335,15 +449,57 @@ class RawTextRefinementCommand(_RawTextCommand):
     def _clear_database(self):
         self._model.objects.all().delete()
 
-    def _create(self, **kwargs):
-        files = tuple(self._get_assets(**kwargs))
+    def _create(self, jobs=1, threads=False, select_folder=None, **kwargs):
+        workers = jobs or os.cpu_count() or 1
+        files = tuple(
+            self._get_assets(select_folder=select_folder,
+                             workers=workers if workers > 1 else None,
+                             **kwargs))
         assert files
-        self._model.create_en_masse(tuple(map(self._parse_file, files)))
+        self._git_folder = None
+        if select_folder and len(files) > 1:
+            # Read the Git history of the folder afresh, if dates are needed.
+            forget_git_timestamps(select_folder)
+            self._git_folder = select_folder
+        self._model.create_en_masse(
+            self._parse_files(files, jobs=jobs, threads=threads))
+
+    def _parse_files(self,
+                     files: Sequence[Path],
+                     jobs=1,
+                     threads=False) -> Iterable[Raw]:
+        """Parse files, in parallel workers if so requested.
+
+        Serial parsing is lazy, so that each file's data can be consumed
+        before the next file is read.
+
+        Worker processes receive a pickled copy of the command, and are
+        forked on Linux, to inherit the Django site. Worker threads
+        share the command and avoid pickling, which suits slow storage
+        better than it suits large files.
+
+        """
+        workers = jobs or os.cpu_count() or 1
+        if workers == 1 or len(files) == 1:
+            return map(self._parse_file, files)
+
+        if threads:
+            with ThreadPoolExecutor(max_workers=min(workers,
+                                                    len(files))) as executor:
+                return tuple(executor.map(self._parse_file, files))
+
+        chunksize = max(1, len(files) // (4 * workers))
+        with _process_pool(workers) as executor:
+            return tuple(
+                executor.map(self._parse_file, files, chunksize=chunksize))
 
     def _note_date_updated(self, data: Dict[str, Any],
                            filepath: Path) -> Dict[str, Any]:
         key = self._key_mtime_date
         if key not in data:
+            if self._git_folder:
+                # Once per process, in place of one Git call per file.
+                prime_git_timestamps(self._git_folder, refresh=False)
             data[key] = date_of_last_edit(filepath)
 
         return data
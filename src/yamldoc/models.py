@@ -19,12 +19,24 @@ this program. If not, see <https://www.gnu.org/licenses/>.
 """
 
 import logging
+from contextlib import nullcontext
+from itertools import islice
 
-from django.db import models, transaction
+from django.db import connections, models, router, transaction
 
 from yamldoc.util.misc import slugify
 
 
+def _batches(iterable, size):
+    """Take consecutive batches of passed size from passed iterable."""
+    iterator = iter(iterable)
+    while True:
+        batch = tuple(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
 class MarkupField(models.TextField):
     """A text field expected to contain markup when first instantiated."""
 
@@ -32,24 +44,46 @@ class MarkupField(models.TextField):
 class UploadableMixin():
     """A mix-in for making Django models text-based."""
 
+    # The number of instances inserted per query in mass creation.
+    _batch_size = 1000
+
     @classmethod
-    @transaction.atomic
-    def create_en_masse(cls, raws):
+    def create_en_masse(cls, raws, atomic_all=False):
         """Create a mass of objects from raw data out of text files.
 
         Hierarchical relationships between objects are held over until all
         objects have been registered.
 
+        Each batch of writes to the database is a transaction of its own,
+        unless “atomic_all” is true, in which case the whole operation is a
+        single transaction.
+
         """
-        logging.debug('Instantiating {} en masse.'.format(cls))
-        cls._finishing(cls._instantiate_en_masse(raws))
+        logging.debug('Instantiating %s en masse.', cls)
+        with transaction.atomic() if atomic_all else nullcontext():
+            cls._finishing(cls._instantiate_en_masse(raws))
 
     @classmethod
     def _instantiate_en_masse(cls, raws):
-        """Instantiate model en masse."""
+        """Instantiate model en masse.
+
+        Instances are built without saving and then saved in batches, as
+        raw data is consumed. Tags, which require saved instances, are set
+        after each batch.
+
+        """
+        pairs = cls._iterate_over_raw_data(raws)
+
         by_pk = dict()
-        for raw_data, instance in cls._iterate_over_raw_data(raws):
-            by_pk[instance.pk] = raw_data
+        for batch in _batches(pairs, cls._batch_size):
+            with transaction.atomic():
+                cls._save_en_masse([instance for _, instance in batch])
+                for raw_data, instance in batch:
+                    tags = raw_data.get('tags')
+                    if tags:
+                        # Unlike set(), add() does not read existing tags.
+                        instance.tags.add(*tags)
+                    by_pk[instance.pk] = (raw_data, instance)
 
         return by_pk
 
@@ -57,14 +91,31 @@ class UploadableMixin():
     def _iterate_over_raw_data(cls, raws):
         """Assume each object in the raws describes one instance."""
         for item in raws:
-            new = cls.create(**item)
-            yield item, new
+            yield item, cls.build(**item)
+
+    @classmethod
+    def _save_en_masse(cls, instances):
+        """Save new instances, in bulk where primary keys will be set.
+
+        Bulk insertion cannot be used for multi-table inheritance, nor where
+        the database backend does not return primary keys from it.
+
+        """
+        connection = connections[router.db_for_write(cls)]
+        if (connection.features.can_return_rows_from_bulk_insert
+                and not cls._meta.parents):
+            cls.objects.bulk_create(instances, batch_size=cls._batch_size)
+            return
+
+        for instance in instances:
+            instance.save(force_insert=True)
 
     @classmethod
     def _finishing(cls, by_pk):
         """Add finishing touches after mass instantiation.
 
-        Take a mapping of model instance primary keys to raw data items.
+        Take a mapping of model instance primary keys to pairs of raw data
+        items and the instances made from them.
 
         This default implementation notes hierarchical relationships
         between parent and child objects. It expects:
@@ -76,15 +127,28 @@ class UploadableMixin():
 
         """
         # Add parents, which we presume are now saved.
-        for pk, item in by_pk.items():
-            sluggable = item.get('parent_object')
-            if not sluggable:
-                continue
-
-            slug = slugify(sluggable)
-            try:
-                parent = cls.objects.get(slug=slug)
-            except cls.DoesNotExist:
+        sluggables = {
+            pk: item['parent_object']
+            for pk, (item, _) in by_pk.items() if item.get('parent_object')
+        }
+        if not sluggables:
+            return
+
+        slugs = {pk: slugify(s) for pk, s in sluggables.items()}
+
+        # Prefer new instances, whose slugs are known, to database queries.
+        new = {instance.slug: instance for _, instance in by_pk.values()}
+        parents = {slug: new[slug] for slug in slugs.values() if slug in new}
+        unknown = set(slugs.values()) - parents.keys()
+        if unknown:
+            found = cls.objects.filter(slug__in=unknown)
+            parents.update((p.slug, p) for p in found.iterator(
+                chunk_size=cls._batch_size))
+
+        adopted = []
+        for pk, sluggable in sluggables.items():
+            parent = parents.get(slugs[pk])
+            if parent is None:
                 s = 'Stated parent “{}” not found.'
                 logging.error(s.format(sluggable))
                 continue
@@ -94,9 +158,23 @@ class UploadableMixin():
                 logging.error(s.format(sluggable))
                 continue
 
-            child = cls.objects.get(pk=pk)
+            _, child = by_pk[pk]
             child.parent_object = parent
-            child.save()
+            adopted.append(child)
+
+        for batch in _batches(adopted, cls._batch_size):
+            with transaction.atomic():
+                cls.objects.bulk_update(batch, ['parent_object'])
+
+    @classmethod
+    def build(cls, title='', parent_object=None, tags=None, **kwargs):
+        """Instantiate without saving.
+
+        Ignore parent object, because it may not be saved yet. Ignore tags,
+        because they can only be set on a saved instance.
+
+        """
+        return cls(title=title, slug=slugify(title), **kwargs)
 
     @classmethod
     def create(cls, title='', parent_object=None, tags=None, **kwargs):
@@ -105,10 +183,10 @@ class UploadableMixin():
         Assume that any tags are to be managed as if by Taggit.
 
         """
-        slug = slugify(title)
-        new = cls.objects.create(title=title, slug=slug, **kwargs)
+        new = cls.build(title=title, **kwargs)
+        new.save(force_insert=True)
         if tags:
-            new.tags.set(tags)
+            new.tags.add(*tags)
         return new
 
 
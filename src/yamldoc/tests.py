@@ -19,19 +19,40 @@ this program. If not, see <https://www.gnu.org/licenses/>.
 
 """
 
+import os
+import subprocess
 from collections import OrderedDict as OD
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Barrier
+from unittest.mock import patch
 
 import django.template.defaultfilters
-from django.db.models import AutoField, Model, TextField
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db.models import (CASCADE, AutoField, ForeignKey, Model,
+                              PositiveIntegerField, TextField)
 from django.test import TestCase
+from markdown import markdown
 
+from yamldoc.management.misc import (RawTextRefinementCommand, _name_checker,
+                                     _process_pool)
 from yamldoc.models import Document, MarkupField
-from yamldoc.util.markup import Inline
+from yamldoc.util.file import (count_lines, existing_dir, find_assets,
+                               find_assets_parallel, load,
+                               prime_git_timestamps, timestamp_of_last_edit)
+from yamldoc.util.markup import Inline, media
 from yamldoc.util.misc import field_order_fn, slugify, unique_alphabetizer
 from yamldoc.util.placeholder import lacuna
 from yamldoc.util.placeholder import map as placemap
-from yamldoc.util.resolution import combo, map_resolver, markdown_on_string
+from yamldoc.util.resolution import (combo, inline_on_string, map_resolver,
+                                     markdown_on_string)
 from yamldoc.util.traverse import classbased_selector, get_explicit_fields
+from yamldoc.util.traverse import model as traverse_model
 
 
 class ConcreteDocument(Document):
@@ -40,6 +61,15 @@ class ConcreteDocument(Document):
     id = AutoField(primary_key=True)
 
 
+class Annotation(Model):
+    """A test-only model with a generic relation, and no markup."""
+
+    id = AutoField(primary_key=True)
+    content_type = ForeignKey(ContentType, on_delete=CASCADE)
+    object_id = PositiveIntegerField()
+    content_object = GenericForeignKey()
+
+
 class _UpstreamCharacterization(TestCase):
     """Tests of Django’s behaviour, irrespective of yamldoc."""
 
@@ -171,6 +201,28 @@ class _CookingInternalMarkup(TestCase):
         Nu uh."""
         self.assertEqual(Inline.collective_sub(s0), s1)
 
+    def test_prose(self):
+        with patch.object(Inline, 'collective_sub') as sub:
+            self.assertEqual('Plain { prose }.',
+                             inline_on_string('Plain { prose }.'))
+        sub.assert_not_called()
+
+    def test_transclusion(self):
+        with TemporaryDirectory() as folder:
+            path = Path(folder) / 'a.svg'
+            path.write_bytes(b'<svg>\r\n</svg>\r\n')
+            with self.settings(MEDIA_ROOT=folder):
+                self.assertEqual('<svg>\n</svg>\n',
+                                 media('a.svg', transclude=True))
+
+                path.write_bytes(b'<svg/>')
+                os.utime(path, ns=(0, 0))  # Distinct from the first write.
+                self.assertEqual('<svg/>', media('a.svg', transclude=True))
+
+    def test_unbalanced(self):
+        with self.assertRaises(Inline.OpenShorthandError):
+            inline_on_string('Closed}} but never opened.')
+
 
 class _StructuralTransformation(TestCase):
 
@@ -359,6 +411,481 @@ class _CookingSite(TestCase):
         ref = '<p><strong>Cove</strong> is a city in Union County.</p>'
         self.assertEqual(ref, doc.body)
 
+    def test_batches(self):
+        for title in ('a', 'b', 'c'):
+            ConcreteDocument.create(title=title,
+                                    body=f'*{title}*',
+                                    date_created='2016-08-03',
+                                    date_updated='2016-08-04')
+
+        # One query to read the table, then one update per batch.
+        with self.assertNumQueries(3):
+            list(map_resolver(combo, batch_size=2))
+
+        self.assertEqual(['<p><em>a</em></p>', '<p><em>b</em></p>',
+                          '<p><em>c</em></p>'],
+                         [d.body for d in ConcreteDocument.objects.all()])
+
+    def test_related_for_markup(self):
+        dates = dict(date_created='2016-08-03', date_updated='2016-08-04')
+        parent = ConcreteDocument.create(title='a', **dates)
+        for title in ('b', 'c'):
+            child = ConcreteDocument.create(title=title, **dates)
+            child.parent_object = parent
+            child.save()
+
+        def resolver(instance, raw):
+            instance.parent_object  # As if by an Inline handler.
+            return raw
+
+        # Parents are joined, not queried one child at a time.
+        with patch.object(ConcreteDocument,
+                          'related_for_markup', ('parent_object', ),
+                          create=True):
+            with self.assertNumQueries(1):
+                list(map_resolver(resolver))
+
+    def test_related_for_markup_prefetched(self):
+        dates = dict(date_created='2016-08-03', date_updated='2016-08-04')
+        parent = ConcreteDocument.create(title='a', **dates)
+        for title in ('b', 'c'):
+            child = ConcreteDocument.create(title=title, **dates)
+            child.parent_object = parent
+            child.save()
+
+        seen = {}
+
+        def resolver(instance, raw):
+            seen[instance.title] = [c.title for c in instance.children.all()]
+            return raw
+
+        # One query for the table and one for children, per chunk.
+        with patch.object(ConcreteDocument,
+                          'related_for_markup', ('children', ),
+                          create=True):
+            with self.assertNumQueries(2):
+                list(map_resolver(resolver))
+            self.assertEqual({'a': ['b', 'c'], 'b': [], 'c': []}, seen)
+
+            seen.clear()
+            with patch('yamldoc.util.traverse._ITERATOR_PREFETCHES', False):
+                with patch('yamldoc.util.traverse.CHUNK_SIZE', 2):
+                    with self.assertNumQueries(4):
+                        list(map_resolver(resolver))
+            self.assertEqual({'a': ['b', 'c'], 'b': [], 'c': []}, seen)
+
+    def test_related_for_markup_generic(self):
+        dates = dict(date_created='2016-08-03', date_updated='2016-08-04')
+        for title in ('a', 'b'):
+            document = ConcreteDocument.create(title=title, **dates)
+            Annotation.objects.create(content_object=document)
+        field = Annotation._meta.get_field('object_id')
+
+        # Generic foreign keys cannot be joined, so they are prefetched.
+        with patch.object(Annotation,
+                          'related_for_markup', ('content_object', ),
+                          create=True):
+            with self.assertNumQueries(2):
+                titles = [
+                    node[0].content_object.title
+                    for node in traverse_model(Annotation, lambda _: (field, ))
+                ]
+
+        self.assertEqual(['a', 'b'], titles)
+
+    def test_partial_consumption(self):
+        for title in ('a', 'b'):
+            ConcreteDocument.create(title=title,
+                                    body=f'*{title}*',
+                                    date_created='2016-08-03',
+                                    date_updated='2016-08-04')
+
+        # any() stops at the first change, leaving the iterator unfinished.
+        self.assertTrue(any(map_resolver(combo)))
+        self.assertEqual('<p><em>a</em></p>',
+                         ConcreteDocument.objects.get(title='a').body)
+
+    def test_unchanged(self):
+        ConcreteDocument.create(title='a',
+                                body='*a*',
+                                date_created='2016-08-03',
+                                date_updated='2016-08-04')
+        list(map_resolver(combo))
+
+        # An identity resolver changes nothing, so nothing is written.
+        with self.assertNumQueries(1):
+            self.assertFalse(any(map_resolver(lambda _, raw: raw)))
+
+
+class _MassCreation(TestCase):
+
+    def _raw(self, title, **kwargs):
+        return dict(title=title,
+                    date_created='2016-08-03',
+                    date_updated='2016-08-04',
+                    **kwargs)
+
+    def test_flat(self):
+        ConcreteDocument.create_en_masse(
+            [self._raw('Cove, Oregon'),
+             self._raw('Union County')])
+        slugs = sorted(d.slug for d in ConcreteDocument.objects.all())
+        self.assertEqual(['cove-oregon', 'union-county'], slugs)
+
+    def test_batches(self):
+        raws = (self._raw(f'Document {i}') for i in range(5))
+        with patch.object(ConcreteDocument, '_batch_size', 2):
+            ConcreteDocument.create_en_masse(raws)
+        self.assertEqual(5, ConcreteDocument.objects.count())
+
+    def test_parent(self):
+        ConcreteDocument.create_en_masse([
+            self._raw('Cove, Oregon', parent_object='Union County'),
+            self._raw('Union County')
+        ])
+        child = ConcreteDocument.objects.get(slug='cove-oregon')
+        self.assertEqual('Union County', child.parent_object.title)
+        parent = ConcreteDocument.objects.get(slug='union-county')
+        self.assertIsNone(parent.parent_object)
+
+    def test_preexisting_parent(self):
+        ConcreteDocument.create(**self._raw('Union County'))
+        ConcreteDocument.create_en_masse(
+            [self._raw('Cove, Oregon', parent_object='Union County')])
+        child = ConcreteDocument.objects.get(slug='cove-oregon')
+        self.assertEqual('Union County', child.parent_object.title)
+
+    def test_missing_parent(self):
+        with self.assertLogs(level='ERROR'):
+            ConcreteDocument.create_en_masse(
+                [self._raw('Cove, Oregon', parent_object='Oregon')])
+        child = ConcreteDocument.objects.get(slug='cove-oregon')
+        self.assertIsNone(child.parent_object)
+
+    def test_own_parent(self):
+        with self.assertLogs(level='ERROR'):
+            ConcreteDocument.create_en_masse(
+                [self._raw('Oregon', parent_object='Oregon')])
+        self.assertIsNone(ConcreteDocument.objects.get().parent_object)
+
+
+class _Deserialization(TestCase):
+
+    def test_mapping(self):
+        self.assertEqual({'a': [1, 'b']}, load('a:\n  - 1\n  - b\n'))
+
+    def test_supplementary_plane(self):
+        # Originally a problem with PyYAML’s pure-Python reader.
+        self.assertEqual({'a': '\U0001F600'}, load('a: \U0001F600'))
+
+    def test_binary_stream(self):
+        stream = BytesIO('a: å\n'.encode('utf-8'))
+        self.assertEqual({'a': 'å'}, load(stream))
+
+
+class _LineCounting(TestCase):
+
+    def _count(self, content):
+        with TemporaryDirectory() as folder:
+            path = Path(folder) / 'f.yaml'
+            path.write_bytes(content)
+            return count_lines(path)
+
+    def test_empty(self):
+        self.assertEqual(1, self._count(b''))
+
+    def test_terminated(self):
+        self.assertEqual(3, self._count(b'a\nb\n'))
+
+    def test_unterminated(self):
+        self.assertEqual(3, self._count(b'a\nb'))
+
+    def test_blank_lines(self):
+        self.assertEqual(4, self._count(b'\n\n\n'))
+
+
+class _AssetFinding(TestCase):
+
+    def test_scan(self):
+        with TemporaryDirectory() as folder:
+            root = Path(folder)
+            (root / 'sub').mkdir()
+            (root / 'folder.yaml').mkdir()
+            for name in ('a.yaml', 'p_b.yaml', 'sub/p_c.yaml', 'sub/d.txt'):
+                (root / name).write_text('')
+
+            found = sorted(p.relative_to(root) for p in find_assets(root))
+            prefixed = sorted(
+                p.relative_to(root) for p in find_assets(root, '**/p_*.yaml'))
+
+        self.assertEqual(
+            [Path('a.yaml'), Path('p_b.yaml'),
+             Path('sub/p_c.yaml')], found)
+        self.assertEqual([Path('p_b.yaml'), Path('sub/p_c.yaml')], prefixed)
+
+    def test_overlap(self):
+        # A prefix and suffix that overlap must not match the same letters.
+        with TemporaryDirectory() as folder:
+            root = Path(folder)
+            (root / 'sub').mkdir()
+            for name in ('ab', 'abb', 'sub/ab', 'sub/abxb'):
+                (root / name).write_text('')
+
+            globbed = sorted(root.glob('**/ab*b'))
+            scanned = sorted(find_assets(root, '**/ab*b'))
+            parallel = sorted(find_assets_parallel(root, '**/ab*b'))
+
+        self.assertEqual([root / 'abb', root / 'sub/abxb'], globbed)
+        self.assertEqual(globbed, scanned)
+        self.assertEqual(globbed, parallel)
+        checker = _name_checker('ab', 'b')
+        self.assertEqual([False, True, True],
+                         list(map(checker, ('ab', 'abb', 'abxb'))))
+
+    def test_parallel(self):
+        with TemporaryDirectory() as folder:
+            root = Path(folder)
+            for name in ('a', 'b', 'b/c'):
+                (root / name).mkdir()
+            for name in ('d.yaml', 'a/e.yaml', 'b/f.yaml', 'b/c/g.yaml'):
+                (root / name).write_text('')
+
+            found = find_assets_parallel(root, workers=2)
+            self.assertEqual(sorted(find_assets(root)), sorted(found))
+
+    def test_unreadable(self):
+        scandir = os.scandir
+
+        def deny(path):
+            if Path(path).name in denied:
+                raise PermissionError(path)
+            return scandir(path)
+
+        with TemporaryDirectory() as folder:
+            root = Path(folder)
+            for name in ('a', 'b'):
+                (root / name).mkdir()
+            for name in ('c.yaml', 'a/d.yaml', 'b/e.yaml'):
+                (root / name).write_text('')
+
+            denied = {'b'}
+            with patch('yamldoc.util.file.os.scandir', deny):
+                found = sorted(find_assets(root))
+                parallel = sorted(find_assets_parallel(root, workers=2))
+            denied.add(root.name)
+            with patch('yamldoc.util.file.os.scandir', deny):
+                empty = list(find_assets_parallel(root))
+
+        self.assertEqual([root / 'a/d.yaml', root / 'c.yaml'], found)
+        self.assertEqual(found, parallel)
+        self.assertEqual([], empty)
+
+    def test_relative_argument(self):
+        cwd = os.getcwd()
+        with TemporaryDirectory() as folder:
+            root = Path(folder).resolve()
+            for name in ('a', 'b'):
+                (root / name).mkdir()
+            try:
+                os.chdir(root / 'a')
+                first = existing_dir('.')
+                os.chdir(root / 'b')
+                second = existing_dir('.')
+            finally:
+                os.chdir(cwd)
+
+        self.assertEqual((root / 'a', root / 'b'), (first, second))
+
+
+class _GitTimestamps(TestCase):
+
+    def _git(self, folder, date, *args):
+        env = dict(os.environ,
+                   GIT_AUTHOR_NAME='a',
+                   GIT_AUTHOR_EMAIL='a@example.com',
+                   GIT_COMMITTER_NAME='a',
+                   GIT_COMMITTER_EMAIL='a@example.com',
+                   GIT_COMMITTER_DATE=date)
+        subprocess.run(['git', *args], cwd=folder, env=env, check=True)
+
+    def _commit(self, folder, date):
+        subprocess.run(['git', 'add', '.'], cwd=folder, check=True)
+        self._git(folder, date, 'commit', '-qm', date)
+
+    def test_priming(self):
+        with TemporaryDirectory() as folder:
+            root = Path(folder)
+            subprocess.run(['git', 'init', '-q'], cwd=root, check=True)
+            (root / 'sub').mkdir()
+            (root / 'sub' / 'a b.yaml').write_text('a: 1\n')
+            (root / 'c.yaml').write_text('c: 1\n')
+            self._commit(root, '@1000000000 +0000')
+            (root / 'c.yaml').write_text('c: 2\n')
+            self._commit(root, '@1100000000 +0000')
+            (root / 'untracked.yaml').write_text('u: 1\n')
+
+            paths = (root / 'sub' / 'a b.yaml', root / 'c.yaml',
+                     root / 'untracked.yaml')
+            before = tuple(map(timestamp_of_last_edit, paths))
+            prime_git_timestamps(root)
+            after = tuple(map(timestamp_of_last_edit, paths))
+
+        self.assertEqual(before[:2], (1000000000.0, 1100000000.0))
+        self.assertEqual(before, after)
+
+    def test_refresh(self):
+        with TemporaryDirectory() as folder:
+            root = Path(folder)
+            subprocess.run(['git', 'init', '-q'], cwd=root, check=True)
+            (root / 'a.yaml').write_text('a: 1\n')
+            self._commit(root, '@1000000000 +0000')
+            prime_git_timestamps(root)
+            first = timestamp_of_last_edit(root / 'a.yaml')
+
+            (root / 'a.yaml').write_text('a: 2\n')
+            self._commit(root, '@1100000000 +0000')
+            prime_git_timestamps(root, refresh=False)
+            kept = timestamp_of_last_edit(root / 'a.yaml')
+            prime_git_timestamps(root)
+            second = timestamp_of_last_edit(root / 'a.yaml')
+
+        self.assertEqual((first, kept, second),
+                         (1000000000.0, 1000000000.0, 1100000000.0))
+
+    def test_threads(self):
+        with TemporaryDirectory() as folder:
+            root = Path(folder)
+            subprocess.run(['git', 'init', '-q'], cwd=root, check=True)
+            for name in 'abcdefgh':
+                (root / f'{name}.yaml').write_text('a: 1\n')
+            self._commit(root, '@1000000000 +0000')
+            barrier = Barrier(8)
+
+            def date(name):
+                barrier.wait()
+                prime_git_timestamps(root, refresh=False)
+                return timestamp_of_last_edit(root / f'{name}.yaml')
+
+            with patch('yamldoc.util.file.run', wraps=subprocess.run) as git:
+                with ThreadPoolExecutor(max_workers=8) as executor:
+                    timestamps = set(executor.map(date, 'abcdefgh'))
+
+        # The history is read once, not once per thread.
+        self.assertEqual(1, git.call_count)
+        self.assertEqual({1000000000.0}, timestamps)
+
+    def test_merge(self):
+        # A merge commit lists no files.
+        with TemporaryDirectory() as folder:
+            root = Path(folder)
+            subprocess.run(['git', 'init', '-q'], cwd=root, check=True)
+            (root / 'a.yaml').write_text('a: 1\n')
+            self._commit(root, '@1000000000 +0000')
+            subprocess.run(['git', 'checkout', '-qb', 'side'],
+                           cwd=root,
+                           check=True)
+            (root / 'b.yaml').write_text('b: 1\n')
+            self._commit(root, '@1100000000 +0000')
+            subprocess.run(['git', 'checkout', '-q', '-'],
+                           cwd=root,
+                           check=True)
+            (root / 'c.yaml').write_text('c: 1\n')
+            self._commit(root, '@1150000000 +0000')
+            self._git(root, '@1200000000 +0000', 'merge', '-q', '--no-edit',
+                      'side')
+
+            paths = tuple(root / n for n in ('a.yaml', 'b.yaml', 'c.yaml'))
+            prime_git_timestamps(root)
+            timestamps = tuple(map(timestamp_of_last_edit, paths))
+
+        self.assertEqual(timestamps,
+                         (1000000000.0, 1100000000.0, 1150000000.0))
+
+
+class DatedRefinementCommand(RawTextRefinementCommand):
+    """A test-only command that notes when its sources were updated."""
+
+    _model = ConcreteDocument
+
+    def _parse_file(self, filepath):
+        return self._note_date_updated(super()._parse_file(filepath),
+                                       filepath)
+
+
+class _Refinement(TestCase):
+
+    def _write(self, root, *titles):
+        for title in titles:
+            (root / f'{title}.yaml').write_text(
+                f'title: {title}\ndate_created: 2016-08-03\n')
+
+    def test_git_unread_without_dates(self):
+        class Command(RawTextRefinementCommand):
+            _model = ConcreteDocument
+
+            def _parse_file(self, filepath):
+                return dict(super()._parse_file(filepath),
+                            date_updated='2016-08-04')
+
+        with TemporaryDirectory() as folder:
+            self._write(Path(folder), 'a', 'b')
+            with patch('yamldoc.management.misc.prime_git_timestamps') as p:
+                Command()._create(select_folder=Path(folder))
+
+        p.assert_not_called()
+        self.assertEqual(2, ConcreteDocument.objects.count())
+
+    def test_git_read_once_for_dates(self):
+        with TemporaryDirectory() as folder:
+            self._write(Path(folder), 'a', 'b')
+            with patch('yamldoc.management.misc.prime_git_timestamps') as p:
+                DatedRefinementCommand()._create(select_folder=Path(folder))
+
+        p.assert_called_with(Path(folder), refresh=False)
+        self.assertEqual(2, ConcreteDocument.objects.count())
+
+    def test_parse_files(self):
+        command = DatedRefinementCommand()
+        with TemporaryDirectory() as folder:
+            self._write(Path(folder), 'a', 'b', 'c')
+            files = sorted(Path(folder).iterdir())
+            serial = list(command._parse_files(files))
+            threaded = command._parse_files(files, jobs=2, threads=True)
+            forked = command._parse_files(files, jobs=2)
+
+        self.assertEqual(['a', 'b', 'c'], [r['title'] for r in serial])
+        self.assertEqual(serial, list(threaded))
+        self.assertEqual(serial, list(forked))
+
+    def test_process_pool(self):
+        module = 'yamldoc.management.misc'
+        with patch(f'{module}.ProcessPoolExecutor') as executor, \
+                patch(f'{module}.connections') as connections:
+            with patch(f'{module}.sys.platform', 'linux'):
+                _process_pool(2)
+            forked = executor.call_args.kwargs
+            with patch(f'{module}.sys.platform', 'darwin'):
+                _process_pool(2)
+            spawned = executor.call_args.kwargs
+
+        # Connections are closed before forking only.
+        connections.close_all.assert_called_once_with()
+        self.assertEqual('fork', forked['mp_context'].get_start_method())
+        self.assertNotIn('initializer', forked)
+        self.assertNotIn('mp_context', spawned)
+        self.assertIs(django.setup, spawned['initializer'])
+
+    def test_job_validation(self):
+        command = DatedRefinementCommand()
+        parser = command.create_parser('manage.py', 'refine')
+        with self.assertRaises(CommandError):
+            parser.parse_args(['--jobs', '-1'])
+        with TemporaryDirectory() as folder:
+            self._write(Path(folder), 'a')
+            with self.assertRaises(CommandError):
+                call_command(command, select_folder=Path(folder), threads=True)
+        self.assertEqual(0, ConcreteDocument.objects.count())
+
 
 class _Other(TestCase):
 
@@ -396,6 +923,10 @@ class _Other(TestCase):
         ref = 'this-sentence-has-some-html'
         self.assertEqual(ref, slugify(s))
 
+    def test_slugification_transliterated(self):
+        self.assertEqual('smorgasbord-a-la-carte',
+                         slugify('Smörgåsbord à la carte'))
+
     def test_strip(self):
         s = 'A salute to <a href="www.plaid.com">plaid</a>.'
         ref = 'A salute to plaid.'
@@ -407,3 +938,31 @@ class _Other(TestCase):
                '<li>li</li>', '</ul>', '<p>p</p>')
 
         self.assertEqual('\n'.join(ref), markdown_on_string('\n'.join(s)))
+
+    def test_markdown_footnotes_reset(self):
+        # Footnote state must not leak from one string to the next.
+        s = 'Text.[^1]\n\n[^1]: Note.'
+        self.assertEqual(markdown_on_string(s), markdown_on_string(s))
+        self.assertEqual('<p>Plain.</p>', markdown_on_string('Plain.'))
+
+    def test_markdown_threads(self):
+        # Documents converted at once in different threads must not mix.
+        def doc(n):
+            body = ''.join(f'# {n} {i}\n\n{i}.[^{i}]\n\n' for i in range(20))
+            return body + ''.join(f'[^{i}]: {n}.\n' for i in range(20))
+
+        docs = list(map(doc, range(64)))
+        serial = list(map(markdown_on_string, docs))
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            self.assertEqual(serial, list(executor.map(markdown_on_string,
+                                                       docs)))
+
+    def test_markdown_plain_prose(self):
+        # Prose that skips Markdown must come out as if it did not.
+        extensions = ('markdown.extensions.footnotes',
+                      'markdown.extensions.toc')
+        for s in ('', 'Plain.', '\nA "quoted" (aside), well-known.\n\n\nB!\n',
+                  'Line 1.\nLine 2.', '1. Item', '- Item', 'Hard  \nbreak',
+                  '  Indented.', 'snake_case', 'A & B'):
+            self.assertEqual(markdown(s, extensions=extensions),
+                             markdown_on_string(s), msg=s)
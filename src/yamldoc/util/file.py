@@ -28,10 +28,44 @@ this program. If not, see <https://www.gnu.org/licenses/>.
 ###########
 
 import datetime
+import os
+import re
+import threading
 from argparse import ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from pathlib import Path
+from queue import Queue
 from subprocess import run
-from typing import Callable, Generator, Optional
+from typing import BinaryIO, Callable, Dict, Generator, Optional, Set, Union
+
+import yaml  # PyPI: PyYAML.
+
+try:
+    # Prefer the C implementation where PyYAML was built with libyaml.
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader  # type: ignore[misc]
+
+#############
+# CONSTANTS #
+#############
+
+CHUNK_SIZE = 1 << 20  # Bytes read at a time when scanning a file.
+
+# A recursive glob pattern for files by literal prefix and suffix alone.
+_SIMPLE_PATTERN = re.compile(r'\*\*/([^*?\[\]/]*)\*([^*?\[\]/]*)')
+
+#########
+# STATE #
+#########
+
+# Timestamps of the last Git commit per file, by absolute path, and the
+# folders whose history has been read for this purpose. Threads share these
+# under a lock, held while Git is read, so that each folder is read once.
+_git_timestamps: Dict[Path, float] = {}
+_git_primed: Set[Path] = set()
+_git_lock = threading.Lock()
 
 #######################
 # INTERFACE FUNCTIONS #
@@ -39,10 +73,30 @@ from typing import Callable, Generator, Optional
 
 
 def count_lines(path: Path) -> int:
-    """Count the number of lines of text in passed file."""
+    """Count the number of lines of text in passed file.
+
+    Newlines are counted in large binary chunks, without splitting lines.
+
+    """
     assert path.is_file()
+    newlines, last = 0, b'\n'
     with path.open(mode='rb') as f:
-        return 1 + sum(1 for line in f)
+        for chunk in iter(partial(f.read, CHUNK_SIZE), b''):
+            newlines += chunk.count(b'\n')
+            last = chunk[-1:]
+
+    # An unterminated final line is still a line.
+    return 1 + newlines + (last != b'\n')
+
+
+def load(stream: Union[str, BinaryIO], Loader=SafeLoader):
+    """Parse passed string or binary file object as YAML.
+
+    Parsing is safe and as fast as available. A binary file object is read
+    and decoded by the parser itself, without an intermediate string.
+
+    """
+    return yaml.load(stream, Loader=Loader)
 
 
 def find_assets(
@@ -63,7 +117,95 @@ def find_assets(
             yield selection
         return
 
-    yield from filter(pred, root.glob(pattern))
+    simple = _SIMPLE_PATTERN.fullmatch(pattern)
+    if simple:
+        yield from filter(pred, _scan(root, *simple.groups()))
+    else:
+        yield from filter(pred, root.glob(pattern))
+
+
+def find_assets_parallel(
+        root: Path,
+        pattern: str = "**/*.yaml",
+        selection: Optional[Path] = None,
+        pred: Callable[[Path], bool] = lambda _: True,
+        workers: int = 8) -> Generator[Path, None, None]:
+    """Generate paths to asset files, reading folders in worker threads.
+
+    This is a variant of find_assets() for callers that will consume all of
+    the results. Each top-level folder under the root is scanned in a
+    thread of its own and paths are generated as they are found. Their
+    order is not fixed. Patterns that find_assets() would glob are globbed
+    in the calling thread.
+
+    """
+    simple = _SIMPLE_PATTERN.fullmatch(pattern)
+    if selection or not simple:
+        yield from find_assets(root, pattern, selection=selection, pred=pred)
+        return
+
+    prefix, suffix = simple.groups()
+    found: Queue = Queue()
+
+    def scan(folder: Path):
+        try:
+            for path in _scan(folder, prefix, suffix):
+                found.put(path)
+        finally:
+            found.put(None)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures, files = [], []
+        try:
+            entries = os.scandir(root)
+        except PermissionError:
+            return
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    futures.append(executor.submit(scan, Path(entry.path)))
+                elif (_matches(entry.name, prefix, suffix)
+                      and entry.is_file()):
+                    files.append(Path(entry.path))
+
+        yield from filter(pred, files)
+
+        # Each task ends by queueing a sentinel, even on failure.
+        pending = len(futures)
+        while pending:
+            path = found.get()
+            if path is None:
+                pending -= 1
+            elif pred(path):
+                yield path
+
+        for future in futures:
+            future.result()  # Raise any exception from a worker.
+
+
+def _scan(root: Path, prefix: str, suffix: str) -> Generator[Path, None, None]:
+    """Generate paths to files by name, recursively, like a simple glob.
+
+    This relies on directory entries to tell files from folders, where glob
+    would query the file system about each path.
+
+    """
+    try:
+        entries = os.scandir(root)
+    except PermissionError:
+        return  # Skip unreadable folders, as glob does.
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scan(Path(entry.path), prefix, suffix)
+            elif _matches(entry.name, prefix, suffix) and entry.is_file():
+                yield Path(entry.path)
+
+
+def _matches(name: str, prefix: str, suffix: str) -> bool:
+    """Match a file name like the glob pattern prefix*suffix."""
+    return (len(name) >= len(prefix) + len(suffix) and name.startswith(prefix)
+            and name.endswith(suffix))
 
 
 def date_of_last_edit(path: Path) -> datetime.date:
@@ -76,7 +218,19 @@ def timestamp_of_last_edit(path: Path) -> float:
 
     Prefer a VCS (Git only) timestamp and fall back to the file system.
 
+    Timestamps noted by prime_git_timestamps are used without asking Git.
+
     """
+    path = path.absolute()
+    with _git_lock:
+        timestamp = _git_timestamps.get(path)
+        primed = any(folder in path.parents for folder in _git_primed)
+    if timestamp is not None:
+        return timestamp
+    if primed:
+        # Not committed.
+        return path.stat().st_mtime
+
     cmd = ['git', 'log', '--max-count=1', '--format=%ct', '--', str(path)]
     git = run(cmd, capture_output=True, cwd=path.parent)
     if git.stdout and not git.returncode:
@@ -85,17 +239,103 @@ def timestamp_of_last_edit(path: Path) -> float:
     return path.stat().st_mtime
 
 
+def prime_git_timestamps(folder: Path, refresh: bool = True) -> None:
+    """Note when each file under passed folder was last committed to Git.
+
+    This reads the history of the whole folder with one call to Git, for use
+    by timestamp_of_last_edit instead of one call per file. Outside of a Git
+    repository, nothing is noted, and file system times will be used.
+
+    Priming a folder again replaces what was noted for it before, unless
+    “refresh” is false, in which case a folder already primed is left alone.
+
+    """
+    folder = folder.absolute()
+    with _git_lock:
+        if not refresh and folder in _git_primed:
+            return
+        timestamps = _read_git_history(folder)
+        _forget(folder)
+        _git_timestamps.update(timestamps)
+        _git_primed.add(folder)
+
+
+def forget_git_timestamps(folder: Path) -> None:
+    """Drop what prime_git_timestamps noted for passed folder."""
+    with _git_lock:
+        _forget(folder.absolute())
+
+
+def _forget(folder: Path) -> None:
+    for path in [p for p in _git_timestamps if folder in p.parents]:
+        del _git_timestamps[path]
+    _git_primed.discard(folder)
+
+
+def _read_git_history(folder: Path) -> Dict[Path, float]:
+    cmd = [
+        'git', 'log', '--name-only', '--relative', '-z', '--format=%x00%ct',
+        '--', '.'
+    ]
+    try:
+        git = run(cmd, capture_output=True, cwd=folder)
+    except OSError:  # No Git.
+        git = None
+
+    # Each commit is a NUL, its timestamp and a NUL. Unless it lists no files,
+    # as for a merge, a newline follows, then NUL-terminated file paths.
+    # Paths are never empty, so two NULs in a row only separate commits.
+    # Commits are listed from newest to oldest.
+    timestamps: Dict[Path, float] = {}
+    records = git.stdout.split(b'\0\0') if git and not git.returncode else ()
+    for record in records:
+        fields = record.strip(b'\0').split(b'\0')
+        if not fields[0]:
+            continue
+        timestamp, paths = float(fields[0]), fields[1:]
+        if paths:
+            paths[0] = paths[0][1:]  # The newline.
+        for path in paths:
+            timestamps.setdefault(folder / os.fsdecode(path), timestamp)
+    return timestamps
+
+
 def existing_file(candidate: str):
     """Convert a CLI argument to an absolute file path."""
-    path = Path(candidate).resolve()
-    if not path.is_file():
-        raise ArgumentTypeError(f"Not a file: {path}")
-    return path
+    return _existing(candidate, folder=False)
 
 
 def existing_dir(candidate: str):
     """Convert a CLI argument to an absolute folder path."""
-    path = Path(candidate).resolve()
-    if not path.is_dir():
+    return _existing(candidate, folder=True)
+
+
+def _existing(candidate: str, folder: bool) -> Path:
+    """Resolve a path and check its type.
+
+    Absolute paths are checked once per argument string. Relative paths are
+    checked every time, because they depend on the working directory.
+
+    """
+    if os.path.isabs(candidate):
+        return _existing_absolute(candidate, folder)
+    return _check(Path(candidate).resolve(), folder)
+
+
+@lru_cache(maxsize=1024)
+def _existing_absolute(candidate: str, folder: bool) -> Path:
+    """Check an absolute path, caching success.
+
+    Failures are not cached, so a path that comes into existence during the
+    life of the process will pass on a later try.
+
+    """
+    return _check(Path(candidate).resolve(), folder)
+
+
+def _check(path: Path, folder: bool) -> Path:
+    if folder and not path.is_dir():
         raise ArgumentTypeError(f"Not a folder: {path}")
+    if not folder and not path.is_file():
+        raise ArgumentTypeError(f"Not a file: {path}")
     return path
@@ -24,6 +24,7 @@ this program. If not, see <https://www.gnu.org/licenses/>.
 import logging
 import os
 import re
+from functools import lru_cache
 from typing import Optional
 
 import django.conf
@@ -76,21 +77,36 @@ def media(path_fragment,
     if transclude:
         # Produce the full contents of e.g. an SVG file. No label.
         filepath = os.path.join(django.conf.settings.MEDIA_ROOT, path_fragment)
-        try:
-            with open(filepath, mode='r', encoding='utf-8') as f:
-                repl = f.read()
-        except UnicodeDecodeError:
-            logging.error('Failed to read Unicode from {}.'.format(filepath))
-            raise
+        repl = _read_transclusion(filepath, os.stat(filepath).st_mtime_ns)
     else:
         # Produce a link.
-        root = django.conf.settings.MEDIA_URL
-        href = root + path_fragment
-        repl = '<a href="{}">{}</a>'.format(href, label)
+        href = django.conf.settings.MEDIA_URL + path_fragment
+        repl = f'<a href="{href}">{label}</a>'
 
     return repl
 
 
+@lru_cache(maxsize=64)
+def _read_transclusion(filepath: str, mtime_ns: int) -> str:
+    """Read a media file as text, as of its last modification.
+
+    The same file tends to be transcluded in many places, so the text is
+    cached. It is decoded in one piece, with newlines translated as they
+    would be when reading in text mode.
+
+    """
+    with open(filepath, mode='rb') as f:
+        data = f.read()
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError:
+        logging.error('Failed to read Unicode from {}.'.format(filepath))
+        raise
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+
 def static(path_fragment: str,
            subject: Optional[Model] = None,
            label: Optional[str] = None):
@@ -99,14 +115,12 @@ def static(path_fragment: str,
         label = path_fragment
 
     # Produce a link.
-    root = django.conf.settings.STATIC_URL
-    href = root + path_fragment
-    repl = '<a href="{}">{}</a>'.format(href, label)
+    href = django.conf.settings.STATIC_URL + path_fragment
+    repl = f'<a href="{href}">{label}</a>'
 
     return repl
 
 
 def table_of_contents(subject: Optional[Model] = None, heading='Contents'):
     """Produce Markdown for a TOC with a heading that won’t appear in it."""
-    return '<h2 id="{s}">{h}</h2>\n[TOC]'.format(s=misc.slugify(heading),
-                                                 h=heading)
+    return f'<h2 id="{misc.slugify(heading)}">{heading}</h2>\n[TOC]'
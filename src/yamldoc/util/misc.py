@@ -23,6 +23,7 @@ this program. If not, see <https://www.gnu.org/licenses/>.
 # IMPORTS #
 ###########
 
+from functools import lru_cache
 from typing import Any, Callable, Dict, Tuple
 
 import django.utils.html
@@ -39,14 +40,26 @@ Raw = Dict[str, Any]
 
 
 def slugify(string):
-    """Return a slug representing passed string."""
-    clean = django.utils.html.strip_tags(str(string))
+    """Return a slug representing passed string.
+
+    Results are cached, because the same strings tend to recur, e.g. as
+    references to parent objects in bulk uploads.
+
+    """
+    return _slugify(str(string))
+
+
+@lru_cache(maxsize=8192)
+def _slugify(string: str) -> str:
+    clean = django.utils.html.strip_tags(string)
     if not clean:
         s = 'Failed to slugify "{}": Nothing left after HTML tags.'
         raise ValueError(s.format(string))
 
-    # The following imitates django-taggit.
-    slug = default_slugify(unidecode.unidecode(clean))
+    # The following imitates django-taggit. Transliteration is a no-op on
+    # ASCII, the common case, which str.isascii detects without a copy.
+    plain = clean if clean.isascii() else unidecode.unidecode(clean)
+    slug = default_slugify(plain)
 
     if not slug:
         s = 'Failed to slugify "{}": Put in {}, got nothing back.'
@@ -61,9 +74,10 @@ def copy_in_order(a: Raw, b: Raw) -> Raw:
     It is assumed here that b already contains some of the entries from a in a
     significant order, but not necessarily all, and/or some entries not in a.
 
+    Entries already in b keep their position, as with assignment by key.
+
     """
-    for k in a:
-        b[k] = a[k]
+    b.update(a)
     return b
 
 
@@ -87,12 +101,7 @@ def field_order_fn(fields: Tuple[str],
         with its internal order unchanged.
 
         """
-        ordered: Raw = {}
-        for f in fields:
-            try:
-                ordered[f] = fragment[f]
-            except KeyError:
-                pass
+        ordered: Raw = {f: fragment[f] for f in fields if f in fragment}
         return finalizer(fragment, ordered)
 
     return order
@@ -27,6 +27,7 @@ this program. If not, see <https://www.gnu.org/licenses/>.
 
 """
 
+from functools import lru_cache
 from typing import List, Tuple
 
 #######################
@@ -34,8 +35,13 @@ from typing import List, Tuple
 #######################
 
 
+@lru_cache(maxsize=32)
 def placeholder(template: str, indentation: str = '  ', level: int = 1):
-    """Produce a placeholder for human input in YAML."""
+    """Produce a placeholder for human input in YAML.
+
+    Templates recur with the same indentation, so results are cached.
+
+    """
     return template.format(level * indentation)
 
 
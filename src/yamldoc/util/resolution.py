@@ -19,11 +19,12 @@ this program. If not, see <https://www.gnu.org/licenses/>.
 
 """
 
-from functools import partial
-from typing import Callable, Optional
+import re
+import threading
+from typing import Callable, Iterable, List, Optional, Set
 
 from django.db.models import Model
-from markdown import markdown
+from markdown import Markdown
 from yamlwrap import unwrap
 
 from yamldoc.util.markup import Inline
@@ -35,18 +36,84 @@ from yamldoc.util.traverse import Node, site
 
 Resolver = Callable[[Model, Optional[str]], Optional[str]]
 
+###########
+# OBJECTS #
+###########
+
+# Markdown converters, one per thread, because each keeps state while it
+# works on a document. They are built on first use by _markdown().
+_MARKDOWN = threading.local()
+
+# Anything that could make Markdown do more than split paragraphs.
+_MARKUP = re.compile(
+    r"""
+    [^\w\ \n,.;:!?'"()-]  # A character outside plain prose.
+  | _                     # Emphasis.
+  | ^[\d-]                # A list item or a rule.
+  | ^\ | \ $              # Indentation or a hard line break.
+    """, re.MULTILINE | re.VERBOSE)
+
+_PARAGRAPH_BREAK = re.compile(r'\n{2,}')
+
 #############
 # TRAVERSAL #
 #############
 
 
-def map_resolver(resolver: Resolver, **kwargs):
-    """Map a markup resolution function (a resolver) over a Django site."""
-    return map(partial(visit_field, resolver), site(**kwargs))
+def map_resolver(resolver: Resolver, batch_size: int = 500, **kwargs):
+    """Map a markup resolution function (a resolver) over a Django site.
+
+    Return an iterator of Booleans for whether each field was changed.
+    Changed instances are saved in batches, with one query per batch, as the
+    iterator is consumed. Pending changes are saved when the iterator is
+    exhausted or closed, including when it is dropped partway.
+
+    """
+    return _resolve_in_batches(resolver, site(**kwargs), batch_size)
+
+
+def _resolve_in_batches(resolver: Resolver, nodes: Iterable[Node],
+                        batch_size: int):
+    """Visit nodes without saving, then update changed instances in bulk.
 
+    The site traversal produces all fields of one instance, and all instances
+    of one model, in succession. Each batch is therefore of a single model
+    and no instance is saved before all of its fields are resolved.
 
-def visit_field(resolver: Resolver, node: Node):
-    """Resolve markup in one field of one instance."""
+    """
+    batch: List[Model] = []
+    fields: Set[str] = set()
+
+    def flush():
+        if batch:
+            type(batch[0]).objects.bulk_update(batch, fields)
+        batch.clear()
+        fields.clear()
+
+    # Flush even if the consumer stops early, as with any().
+    try:
+        for node in nodes:
+            changed = visit_field(resolver, node, save=False)
+            if changed:
+                instance, field, _ = node
+                if not batch or batch[-1] is not instance:
+                    if batch and (len(batch) >= batch_size
+                                  or type(batch[-1]) is not type(instance)):
+                        flush()
+                    batch.append(instance)
+                fields.add(field.name)
+            yield changed
+    finally:
+        flush()
+
+
+def visit_field(resolver: Resolver, node: Node, save: bool = True) -> bool:
+    """Resolve markup in one field of one instance.
+
+    Return True if the contents of the field were changed. Only then, and
+    only if so requested, save the field.
+
+    """
     instance, field, prior_contents = node
     new_contents = None
     if prior_contents is not None:
@@ -54,8 +121,12 @@ def visit_field(resolver: Resolver, node: Node):
     if new_contents is None and not field.null:
         # "The Django convention is to use the empty string...”
         new_contents = ''
+    if new_contents == prior_contents:
+        return False
     setattr(instance, field.name, new_contents)
-    instance.save()
+    if save:
+        instance.save(update_fields=[field.name])
+    return True
 
 
 #############
@@ -65,18 +136,41 @@ def visit_field(resolver: Resolver, node: Node):
 # Complete and partial markup resolution functions.
 
 
+def _markdown() -> Markdown:
+    """Get a Markdown converter with specific extensions for this thread."""
+    converter = getattr(_MARKDOWN, 'converter', None)
+    if converter is None:
+        converter = Markdown(extensions=[
+            'markdown.extensions.footnotes', 'markdown.extensions.toc'
+        ])
+        _MARKDOWN.converter = converter
+    return converter.reset()
+
+
 def markdown_on_string(raw: str) -> str:
     """Convert markdown to HTML with specific extensions.
 
     This requires the raw input to be unwrapped already.
 
+    Plain prose, in which Markdown would only find paragraphs, is wrapped in
+    paragraph tags without running Markdown, with the same result.
+
     """
-    extensions = ['markdown.extensions.footnotes', 'markdown.extensions.toc']
-    return markdown(raw, extensions=extensions)
+    if not _MARKUP.search(raw):
+        paragraphs = _PARAGRAPH_BREAK.split(raw.strip('\n'))
+        return '\n'.join(f'<p>{p}</p>' for p in paragraphs if p)
+    return _markdown().convert(raw)
 
 
 def inline_on_string(raw: str, **kwargs) -> str:
-    """Resolve all registered Inline Ovid markup in passed string."""
+    """Resolve all registered Inline Ovid markup in passed string.
+
+    Most strings contain no markup. Without either delimiter, there is
+    nothing to resolve and nothing unbalanced to report, so Ovid is skipped.
+
+    """
+    if Inline.lead_in not in raw and Inline.lead_out not in raw:
+        return raw
     return Inline.collective_sub(raw, **kwargs)
 
 
@@ -19,11 +19,13 @@ this program. If not, see <https://www.gnu.org/licenses/>.
 
 """
 
+from functools import lru_cache
 from typing import (Callable, FrozenSet, Generator, Hashable, Optional, Tuple,
                     Type, Union, cast)
 
 import django.apps
 from django.db.models import Field, Model
+from django.db.models.constants import LOOKUP_SEP
 
 from yamldoc.models import MarkupField
 
@@ -38,6 +40,12 @@ Node = Tuple[Model, Field, Optional[str]]
 Screen = Callable[[Type[Model]], bool]
 Traversal = Generator[Node, None, None]
 
+#############
+# CONSTANTS #
+#############
+
+CHUNK_SIZE = 2000  # Rows fetched from the database at a time in traversal.
+
 ############
 # INTERNAL #
 ############
@@ -52,6 +60,55 @@ def _apps_from_site():
     return django.apps.apps.all_models.values()
 
 
+@lru_cache(maxsize=1)
+def _default_screen() -> Screen:
+    return screen_from_field_selector()
+
+
+# Before Django 4.1, iterator() ignored prefetch_related().
+_ITERATOR_PREFETCHES = django.VERSION >= (4, 1)
+
+
+def _instances(model_: Type[Model]) -> Generator[Model, None, None]:
+    """Fetch instances in chunks, with their relations to markup, if any.
+
+    Relations to single objects are joined where Django can join them, that
+    is, by concrete foreign keys and one-to-one relations in either direction.
+    Anything else, including generic foreign keys and lookups that span
+    relations, is prefetched for each chunk.
+
+    """
+    joined, prefetched = [], []
+    for name in get_related_for_markup(model_):
+        field = None if LOOKUP_SEP in name else model_._meta.get_field(name)
+        if field and (field.one_to_one
+                      or field.many_to_one and field.concrete):
+            joined.append(name)
+        else:
+            prefetched.append(name)
+
+    queryset = model_.objects.all()
+    if joined:
+        queryset = queryset.select_related(*joined)
+    if not prefetched:
+        yield from queryset.iterator(chunk_size=CHUNK_SIZE)
+        return
+
+    queryset = queryset.prefetch_related(*prefetched)
+    if _ITERATOR_PREFETCHES:
+        yield from queryset.iterator(chunk_size=CHUNK_SIZE)
+        return
+
+    # Evaluate each chunk as a list instead, paging by primary key.
+    queryset = queryset.order_by('pk')
+    chunk = list(queryset[:CHUNK_SIZE])
+    while chunk:
+        yield from chunk
+        if len(chunk) < CHUNK_SIZE:
+            break
+        chunk = list(queryset.filter(pk__gt=chunk[-1].pk)[:CHUNK_SIZE])
+
+
 ###################
 # FIELD SELECTION #
 ###################
@@ -75,18 +132,36 @@ def get_explicit_fields(model: Model) -> Tuple[Type[Field], ...]:
     return model.fields_with_markup
 
 
+def get_related_for_markup(model: Type[Model]) -> Tuple[str, ...]:
+    """Name relations that markup resolution will follow on passed model.
+
+    Like get_explicit_fields, this reads an explicit opt-in attribute,
+    "related_for_markup", listing field names or lookups that resolvers
+    will reach through the instance. Without it, nothing is fetched ahead.
+
+    """
+    return getattr(model, 'related_for_markup', ())
+
+
 def classbased_selector(allowlist: Tuple[Type[Field], ...]):
-    """Close over an allowlist as a fallback to get_explicit_fields."""
+    """Close over an allowlist as a fallback to get_explicit_fields.
+
+    The fields of a model do not change at runtime, so the selection is
+    memoized per model.
+
+    """
     assert allowlist  # isinstance does not accept an empty tuple.
 
+    @lru_cache(maxsize=None)
     def field_selector(model: Model) -> Tuple[Field, ...]:
         try:
             return get_explicit_fields(model)
         except AttributeError:  # No metadata specifically on markup.
             pass  # Fall back to inspection.
+        # Fields with columns, not relations. Parents' fields are included.
         return tuple(
             filter(lambda f: isinstance(f, allowlist),
-                   model._meta.get_fields()))
+                   model._meta.concrete_fields))
 
     return field_selector
 
@@ -155,16 +230,22 @@ def site(**kwargs) -> Traversal:
 
 
 def app(app_,
-        screen: Screen = screen_from_field_selector(),
+        screen: Optional[Screen] = None,
         field_selector=markup_field_selector) -> Traversal:
     """Traverse fields in the database of one app.
 
     The app here is expected to be packaged as if by site(). There is no
     Application class in Django 3.2.
 
+    The default screen selects models with markup fields. It is defined on
+    first use, not at import, so that it covers every model registered by
+    then, and it is reused afterwards.
+
     The default field_selector is effectively a no-op.
 
     """
+    if screen is None:
+        screen = _default_screen()
     for model_ in filter(screen, app_.values()):
         yield from model(model_, field_selector)
 
@@ -173,14 +254,27 @@ def model(
         model_: Type[Model],
         field_selector: Callable[[Type[Model]],
                                  Tuple[Type[Field]]]) -> Traversal:
-    """Traverse selected fields in the database table of passed model."""
+    """Traverse selected fields in the database table of passed model.
+
+    Rows are fetched in chunks, not all at once, and instances are not
+    cached on a queryset. Relations named by get_related_for_markup are
+    fetched along with each chunk.
+
+    """
     assert field_selector is not None
-    field_allowlist: FrozenSet[Field] = frozenset(field_selector(model_))
-    for instance_ in model_.objects.all():
-        yield from instance(instance_, field_allowlist)
+    field_allowlist: Tuple[Field, ...] = tuple(field_selector(model_))
+    for instance_ in _instances(model_):
+        # Equivalent to instance(), without a generator per instance.
+        for field in field_allowlist:
+            yield (instance_, field, getattr(instance_, field.name))
 
 
-def instance(instance_: Model, field_allowlist: FrozenSet[Field]) -> Traversal:
-    """Traverse selected fields on passed instance of a model."""
+def instance(instance_: Model,
+             field_allowlist: Tuple[Field, ...]) -> Traversal:
+    """Traverse selected fields on passed instance of a model.
+
+    Fields are visited in the order of the allowlist.
+
+    """
     for field in field_allowlist:
         yield (instance_, field, getattr(instance_, field.name))
@@ -4,14 +4,29 @@ http://www.pyinvoke.org/
 
 """
 
+import os
+import shutil
+from pathlib import Path
+
 from invoke import task
 
 
 @task()
 def clean(c):
     """Destroy prior artifacts."""
-    c.run('rm -rf build dist src/*.egg-info', warn=True)
-    c.run(r'find . | grep -E "(__pycache__|\.pyc|\.pyo$$)" | xargs rm -rf')
+    for path in (Path('build'), Path('dist'), *Path('src').glob('*.egg-info')):
+        shutil.rmtree(path, ignore_errors=True)
+
+    # Remove bytecode in one walk, without descending into Git's files.
+    for folder, subfolders, files in os.walk('.'):
+        if '.git' in subfolders:
+            subfolders.remove('.git')
+        if '__pycache__' in subfolders:
+            subfolders.remove('__pycache__')
+            shutil.rmtree(os.path.join(folder, '__pycache__'))
+        for name in files:
+            if name.endswith(('.pyc', '.pyo')):
+                os.remove(os.path.join(folder, name))
 
 
 @task(pre=[clean])